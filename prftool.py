@@ -4,70 +4,240 @@
 # TODO: properly emulate spaces?
 
 # Import Python default libraries
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 import argparse
+import contextlib
 import copy
 import csv
-import itertools
+import functools
+import hashlib
 import logging
+import os
 import pathlib
+import pickle
 import random
-import re
+import sys
+import tempfile
 import unicodedata
 
 # Import other libraries
 import pyclts
 from pyclts import CLTS
 
-
+# `pyahocorasick` is optional, only used to speed up segmentation
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# The path to the CLTS data, set with `set_clts_path()`, and its BIPA
+# transcription system and SCA sound class model; CLTS is only loaded when
+# a segment is not found in `_SEGMENT_INFO`
+_CLTS_PATH = None
+_BIPA = None
+_SCA = None
+
+# The CLTS information for each segment, persisted to disk between runs;
+# only the CLTS data read for the lookups (the transcription systems for
+# BIPA and the sound classes for SCA) is checked for changes
+_SEGMENT_INFO = {}
+_CACHE_DIR = pathlib.Path("~/.cache/prftool").expanduser()
+_CLTS_DATA_DIRS = ("pkg/transcriptionsystems", "pkg/soundclasses")
+
+# Buffer size for reading wordlists, which can be large
+_WORDLIST_BUFFER = 1 << 20
+
+# Segments for the special characters of a form when they are not matched
+# by the profile, in normal and debug mode; boundaries are mapped to NULL
+# in normal mode, so that they are removed along with the NULL segments
+_UNMATCHED_SEGMENTS = {" ": "#", "^": "NULL", "$": "NULL"}
+_UNMATCHED_DEBUG_SEGMENTS = {" ": "{ }/{#}", "^": "{^}/{}", "$": "{$}/{}"}
+
+
+@functools.lru_cache(maxsize=200_000)
 def normalize(text):
     """
     Normalize Unicode data.
+
+    Results are cached, as the same graphemes and forms are found many
+    times in profiles and wordlists; the cache is bounded, as most forms
+    of large wordlists are only found once.
     """
 
     # Only simple NFC normalization for the time being
     return unicodedata.normalize("NFC", text)
 
 
+@functools.lru_cache(maxsize=None)
 def unicode2codepointstr(text):
     """
     Returns a codepoint representation to an Unicode string.
+
+    Results are cached, as most graphemes are found in many entries.
     """
 
-    return " ".join(["U+{0:0{1}X}".format(ord(char), 4) for char in text])
+    return " ".join(["U+%04X" % ord(char) for char in text])
 
 
-def ipa2types(ipa_text, clts):
-    # Obtain only the BIPA grapheme, removing left slash if any
-    ipas = [
-        token if "/" not in token else token.split("/")[1]
-        for token in ipa_text.split()
-    ]
+def _clts_path():
+    """
+    Returns the path to the CLTS data, which must have been set.
+    """
+
+    if _CLTS_PATH is None:
+        raise RuntimeError(
+            "The path to the CLTS data is not set; call `set_clts_path()` first."
+        )
+
+    return _CLTS_PATH
+
+
+def _load_clts():
+    """
+    Load CLTS, storing BIPA and the SCA model for the segment lookups.
+    """
+
+    global _BIPA, _SCA
+    clts = CLTS(_clts_path().as_posix())
+    _BIPA = clts.bipa
+    _SCA = clts.soundclass("sca")
+
+
+def segment_info(segment):
+    """
+    Returns the CLTS information for a segment.
+
+    The information is cached, and CLTS is only queried (and loaded, if
+    necessary) for segments not found in the cache.
+    """
+
+    info = _SEGMENT_INFO.get(segment)
+    if info is None:
+        if _BIPA is None:
+            _load_clts()
+
+        sound = _BIPA[segment]
+        info = {
+            "default": str(sound),
+            "type": type(sound).__name__,
+            "sca": _BIPA.translate(segment, _SCA),
+            "unknown": isinstance(sound, pyclts.models.UnknownSound),
+        }
+        _SEGMENT_INFO[segment] = info
+
+    return info
+
+
+def _segment_cache_file():
+    """
+    Returns the path to the segment cache for the current CLTS data.
 
-    # Get a textual representation
-    types = [
-        type(clts.bipa[token]).__name__ if token != "NULL" else "NULL"
-        for token in ipas
+    The cache depends on both the (resolved) path to the CLTS data and the
+    version of `pyclts` used to read it.
+    """
+
+    key = "%s\n%s" % (_clts_path().as_posix(), pyclts.__version__)
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return _CACHE_DIR / ("segments-%s.pkl" % digest)
+
+
+def load_segment_cache():
+    """
+    Load the segment cache from disk, unless CLTS was modified since.
+
+    An unreadable cache (e.g., truncated by an interrupted run) is ignored,
+    starting with an empty one.
+    """
+
+    cache_file = _segment_cache_file()
+    if not cache_file.exists() or not _CLTS_PATH.exists():
+        return
+
+    # Use the most recent modification of the CLTS data; this walks all the
+    # files of the transcription systems and sound classes (a few hundred),
+    # which is still much cheaper than loading CLTS
+    mtimes = [
+        path.stat().st_mtime
+        for data_dir in _CLTS_DATA_DIRS
+        for path in _CLTS_PATH.joinpath(data_dir).rglob("*")
     ]
+    clts_mtime = max(mtimes + [_CLTS_PATH.stat().st_mtime])
+    if clts_mtime < cache_file.stat().st_mtime:
+        try:
+            with open(cache_file, "rb") as handler:
+                _SEGMENT_INFO.update(pickle.load(handler))
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            logging.warning("Ignoring unreadable segment cache: %s", error)
+            _SEGMENT_INFO.clear()
+
+
+def save_segment_cache():
+    """
+    Write the segment cache to disk.
+
+    The cache is written to a temporary file which then replaces the
+    previous one, so that concurrent or interrupted runs never leave a
+    partial cache; failing to write it is not an error.
+    """
+
+    temp_name = None
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=_CACHE_DIR, suffix=".tmp", delete=False
+        ) as handler:
+            temp_name = handler.name
+            pickle.dump(_SEGMENT_INFO, handler)
+        os.replace(temp_name, _segment_cache_file())
+    except OSError as error:
+        logging.warning("Could not write the segment cache: %s", error)
+        if temp_name is not None:
+            pathlib.Path(temp_name).unlink(missing_ok=True)
+
+
+def set_clts_path(path):
+    """
+    Set the path to the CLTS data used for all segment lookups.
+
+    This must be called before using the functions that query CLTS, such as
+    `clean_profile()`, `check_consistency()`, and `output_profile()`; the
+    segment cache for the CLTS data is loaded, and CLTS itself is only
+    loaded when needed.
+    """
 
-    return " ".join(types)
+    global _CLTS_PATH, _BIPA, _SCA
+    _CLTS_PATH = pathlib.Path(path).expanduser().resolve()
+    _BIPA = None
+    _SCA = None
+    _SEGMENT_INFO.clear()
+    _clean_segment.cache_clear()
+    load_segment_cache()
 
 
-def ipa2sca(ipa_text, clts):
+def ipa2types_and_sca(ipa_text):
+    """
+    Returns the textual representations of the BIPA types and SCA classes.
+    """
+
     # Obtain only the BIPA grapheme, removing left slash if any
     ipas = [
         token if "/" not in token else token.split("/")[1]
         for token in ipa_text.split()
     ]
 
-    # Get a textual representation
-    sca = clts.soundclass("sca")
-    types = [
-        clts.bipa.translate(token, sca) if token != "NULL" else "NULL"
-        for token in ipas
-    ]
+    # Get a textual representation of both
+    types = []
+    sca = []
+    for token in ipas:
+        if token == "NULL":
+            types.append("NULL")
+            sca.append("NULL")
+        else:
+            info = segment_info(token)
+            types.append(info["type"])
+            sca.append(info["sca"])
 
-    return " ".join(types)
+    return " ".join(types), " ".join(sca)
 
 
 def read_profile(filename, args):
@@ -78,7 +248,7 @@ def read_profile(filename, args):
     """
 
     profile = []
-    with open(filename) as profile_file:
+    with open(filename, encoding="utf-8", newline="") as profile_file:
         reader = csv.DictReader(profile_file, delimiter="\t")
         for row in reader:
             if not args.nonfc:
@@ -90,24 +260,47 @@ def read_profile(filename, args):
     return profile
 
 
-def check_consistency(profile, clts, args):
+def check_consistency(profile, args):
     """
     Check a profile for consistency, logging problems.
     """
 
     # Collect all grapheme -> ipa possibilities
+    grapheme_col = args.grapheme
+    ipa_col = args.ipa
     mapping = defaultdict(list)
     for entry in profile:
-        mapping[entry[args.grapheme]].append(entry[args.ipa])
+        mapping[entry[grapheme_col]].append(entry[ipa_col])
+
+    # Get all potential BIPA of each distinct mapping, skipping over NULLs,
+    # and resolve the unknown sounds for all unique segments at once
+    mapping_segments = {}
+    for values in mapping.values():
+        for value in values:
+            if value not in mapping_segments:
+                segments = [
+                    segment.split("/")[1] if "/" in segment else segment
+                    for segment in value.split()
+                ]
+                mapping_segments[value] = {
+                    segment
+                    for segment in segments
+                    if segment != "NULL" and segment
+                }
+    unknown_segments = {
+        segment
+        for segment in set().union(*mapping_segments.values())
+        if segment_info(segment)["unknown"]
+    }
 
     # For each grapheme, raise:
     #   - a warning if there are duplicate entries
     #   - an error if there are inconsistencies
     #   - an error if the mapping has invalid BIPA
-    for grapheme in mapping:
+    for grapheme, values in mapping.items():
         # check mapping consistency
-        if len(mapping[grapheme]) >= 2:
-            if len(set(mapping[grapheme])) == 1:
+        if len(values) >= 2:
+            if len(set(values)) == 1:
                 logger.warning(
                     "Duplicate (redundant) entry or entries for grapheme [%s].",
                     grapheme,
@@ -116,27 +309,12 @@ def check_consistency(profile, clts, args):
                 logger.error(
                     "Inconsistency for grapheme [%s]: potential mappings %s.",
                     grapheme,
-                    str(mapping[grapheme]),
+                    str(values),
                 )
 
         # check BIPA consistency
-        for value in mapping[grapheme]:
-            # Get all potential BIPA, skipping over NULLs
-            segments = value.split()
-            segments = [
-                segment.split("/")[1] if "/" in segment else segment
-                for segment in segments
-            ]
-            segments = [
-                segment for segment in segments if segment != "NULL" and segment
-            ]
-
-            # check for unknown sounds
-            unknown = [
-                isinstance(clts.bipa[segment], pyclts.models.UnknownSound)
-                for segment in segments
-            ]
-            if any(unknown):
+        for value in values:
+            if mapping_segments[value] & unknown_segments:
                 logger.error(
                     "Mapping [%s] (%s) -> [%s] (%s) includes at least one unknown sound.",
                     grapheme,
@@ -146,53 +324,94 @@ def check_consistency(profile, clts, args):
                 )
 
 
-def trim_profile(profile, clts, args):
-    # Make a copy of the profile (so we don't change in place) and clear
-    # all frequencies
+def _clear_collected(entry):
+    """
+    Clear in place the information collected when applying a profile.
+    """
+
+    entry["FREQUENCY"] = 0
+    entry["EXAMPLES"] = []
+    entry["LANGUAGES"] = set()
+    entry["TYPES"] = None
+    entry["SCA"] = None
+
+
+def _fresh_profile_rows(profile, prepare_for_apply=False):
+    """
+    Return a copy of the profile rows with frequencies and examples cleared.
+
+    If `prepare_for_apply` is set, all the collected information is cleared.
+    """
+
     new_profile = []
     for entry in profile:
-        new_entry = entry.copy()
-        new_entry["FREQUENCY"] = 0
-        new_entry["EXAMPLES"] = []
+        new_entry = dict(entry)
+        if prepare_for_apply:
+            _clear_collected(new_entry)
+        else:
+            new_entry["FREQUENCY"] = 0
+            new_entry["EXAMPLES"] = []
         new_profile.append(new_entry)
 
+    return new_profile
+
+
+def trim_profile(profile, args, prepare_for_apply=False):
+    """
+    Remove superfluous rules, i.e., those whose grapheme is segmented to the
+    same IPA by the remaining rules.
+
+    Returns the trimmed copy of the profile and the number of rules removed.
+    If `prepare_for_apply` is set, all the collected information is cleared,
+    so that the copy can be passed directly to `apply_profile()`.
+    """
+
+    # Make a copy of the profile (so we don't change in place) and clear
+    # all frequencies
+    new_profile = _fresh_profile_rows(profile, prepare_for_apply)
+
     # build segment map
     segment_map = {entry[args.grapheme]: entry for entry in new_profile}
 
-    # Collect all keys, so that we will gradually remove them; those with
-    # ^ and $ go first
-    graphemes = list(segment_map.keys())
-    bound_graphemes = [
-        grapheme
-        for grapheme in graphemes
-        if grapheme[0] == "^" and grapheme[-1] == "$"
-    ]
-    bound_graphemes += [
-        grapheme
-        for grapheme in graphemes
-        if grapheme[0] == "^" and grapheme[-1] == "$"
-    ]
-    bound_graphemes += [
-        grapheme
-        for grapheme in graphemes
-        if grapheme[0] != "^" and grapheme[-1] == "$"
-    ]
+    # Collect the graphemes to check, so that we will gradually remove them;
+    # those with ^ and $ go first, followed by those with $ only, and then
+    # by all other complex graphemes, from the longest to the shortest (ties
+    # are sorted alphabetically, so the order is deterministic)
+    def check_order(grapheme):
+        return (
+            not (grapheme.startswith("^") and grapheme.endswith("$")),
+            not grapheme.endswith("$"),
+            -len(grapheme),
+            grapheme,
+        )
 
-    check_graphemes = bound_graphemes + sorted(
+    check_graphemes = sorted(
         [
             grapheme
-            for grapheme in bound_graphemes
-            if len(grapheme) > 1 and grapheme not in bound_graphemes
+            for grapheme in segment_map
+            if len(grapheme) > 1 or grapheme.endswith("$")
         ],
-        key=len,
-        reverse=True,
+        key=check_order,
     )
 
+    # Build the segmenter only once, as graphemes which are not in
+    # `segment_map` anymore are not matched
+    segmenter = build_segmenter(segment_map)
+
     # For each entry, we will remove it from `segment_map`, apply the resulting
     # profile, and add the entry back at the end of loop (still expansive, but
-    # orders of magnitude less expansive than making a copy at each iteration)
+    # orders of magnitude less expansive than making a copy at each iteration);
+    # as the segmentation of a rule can only change when one of the rules it
+    # matched is removed, we keep track of the rules that matched each
+    # grapheme and only queue those for checking again
+    queue = deque(check_graphemes)
+    queued = set(check_graphemes)
+    dependents = defaultdict(set)
     removed = 0
-    for grapheme in check_graphemes:
+    while queue:
+        grapheme = queue.popleft()
+        queued.discard(grapheme)
+
         # Remove the current entry from the segment map, skipping if already
         # removed
         if grapheme not in segment_map:
@@ -200,11 +419,17 @@ def trim_profile(profile, clts, args):
         entry = segment_map.pop(grapheme)
         ipa = entry[args.ipa]
 
-        # Obtain the segments without the current rule
-        segments = " ".join(apply_profile_to_form(grapheme, segment_map, args))
+        # Obtain the segments without the current rule, preparing the
+        # grapheme as `segment_row()` does with the forms
+        if args.nobound:
+            tokens = segmenter(grapheme)
+        else:
+            tokens = segmenter("^%s$" % grapheme)
+        segments = " ".join(render_segments(tokens, segment_map, args))
 
         # If the resulting `segments` match the `ipa` reference, don't add the
-        # rule back (but keep track of how many were removed)
+        # rule back (but keep track of how many were removed), and queue the
+        # rules that depended on it
         if ipa == segments:
             logging.info(
                 "Rule for grapheme [%s] (%s) is superfluous, removing it...",
@@ -212,9 +437,17 @@ def trim_profile(profile, clts, args):
                 unicode2codepointstr(grapheme),
             )
             removed += 1
+
+            for dependent in dependents.pop(grapheme, ()):
+                if dependent in segment_map and dependent not in queued:
+                    queue.append(dependent)
+                    queued.add(dependent)
         else:
-            # Add the entry back to segment_map
+            # Add the entry back to segment_map, recording its dependencies
             segment_map[grapheme] = entry
+            for token in tokens:
+                if token in segment_map and token != grapheme:
+                    dependents[token].add(grapheme)
 
     # Drop from `new_profile` everything that is not in `segment_map` anymore
     new_profile = [
@@ -224,37 +457,49 @@ def trim_profile(profile, clts, args):
     return new_profile, removed
 
 
-def clean_profile(profile, clts, args):
+@functools.lru_cache(maxsize=None)
+def _clean_segment(segment):
     """
-    Replace user-provided IPA graphemes with the CLTS/BIPA default ones.
+    Returns the default BIPA grapheme for a segment, keeping slash notation.
+
+    Results are cached, as profiles reuse the same segments in many entries.
     """
 
-    def clean_segment(segment, clts):
-        if "/" in segment:
-            left, right = segment.split("/")
-            return "%s/%s" % (left, str(clts.bipa[right]))
-        else:
-            return str(clts.bipa[segment])
+    if "/" in segment:
+        left, right = segment.split("/")
+        return "%s/%s" % (left, segment_info(right)["default"])
+    else:
+        return segment_info(segment)["default"]
 
-    # We make and return a copy of the profile, following the best practice
-    # of not changing the data structure provided by the user
-    new_profile = []
-    for entry in profile:
-        new_entry = entry.copy()
 
-        # Remove any multiple spaces, split IPA first into segments and then
-        # left- and right- slash information (if any), and use the default
-        ipa_value = re.sub(r"\s+", " ", new_entry[args.ipa]).strip()
-        new_entry[args.ipa] = " ".join(
-            [clean_segment(segment, clts) for segment in ipa_value.split()]
+def clean_profile(profile, args, prepare_for_apply=False):
+    """
+    Replace user-provided IPA graphemes with the CLTS/BIPA default ones.
+
+    The entries are updated in place, as the profile is always the one
+    just loaded by `read_profile()`; the profile is returned for
+    convenience. If `prepare_for_apply` is set, the collected information
+    is also cleared, so that the profile can be passed directly to
+    `apply_profile()`.
+    """
+
+    grapheme_col = args.grapheme
+    ipa_col = args.ipa
+    for entry in profile:
+        # Split IPA first into segments (which also removes any multiple
+        # spaces) and then left- and right- slash information (if any), and
+        # use the default
+        entry[ipa_col] = " ".join(
+            [_clean_segment(segment) for segment in entry[ipa_col].split()]
         )
 
         # Add/override the 'UNICODE' field
-        new_entry["CODEPOINTS"] = unicode2codepointstr(new_entry[args.grapheme])
+        entry["CODEPOINTS"] = unicode2codepointstr(entry[grapheme_col])
 
-        new_profile.append(new_entry)
+        if prepare_for_apply:
+            _clear_collected(entry)
 
-    return new_profile
+    return profile
 
 
 def sort_profile(profile, args):
@@ -265,68 +510,157 @@ def sort_profile(profile, args):
     # NULLs are always placed at the top (with special symbols "^" and "$"
     # first), followed by full forms
     # The general sort is first by length, then alphabetically
+    def sort_key(entry):
+        # `sorted()` computes each key once, so we read each field only once
+        grapheme = entry[args.grapheme]
+        return (
+            grapheme not in ["^", "$"],
+            grapheme != "^",
+            entry[args.ipa] != "NULL",
+            not (grapheme.startswith("^") and grapheme.endswith("$")),
+            len(grapheme),
+            grapheme,
+        )
 
-    sorted_prf = sorted(
-        profile,
-        key=lambda e: (
-            e[args.grapheme] not in ["^", "$"],
-            e[args.grapheme] != "^",
-            e[args.ipa] != "NULL",
-            re.match("\^.*\$", e[args.grapheme]) is None,
-            len(e[args.grapheme]),
-            e[args.grapheme],
-        ),
-    )
+    sorted_prf = sorted(profile, key=sort_key)
 
     return sorted_prf
 
 
-# TODO: this is changing `segment_map` in place, improve
-def apply_profile_to_form(form, language, segment_map, args):
-    # Read and prepare form
-    if not args.nonfc:
-        form = normalize(form)
-    if not args.nonfc:
-        form = "^%s$" % form
+def build_automaton(segment_map):
+    """
+    Build an Aho-Corasick automaton matching all graphemes in a segment map.
+    """
 
-    # apply profile to the form
+    automaton = ahocorasick.Automaton()
+    for grapheme in segment_map:
+        if grapheme:
+            automaton.add_word(grapheme, (len(grapheme), grapheme))
+    automaton.make_automaton()
+
+    return automaton
+
+
+def build_prefix_index(segment_map):
+    """
+    Index the graphemes of a segment map by their first character.
+
+    Each list of candidates is sorted by decreasing length, so that the
+    first match is always the longest one.
+    """
+
+    prefix_index = defaultdict(list)
+    for grapheme in segment_map:
+        if grapheme:
+            prefix_index[grapheme[0]].append((len(grapheme), grapheme))
+
+    for candidates in prefix_index.values():
+        candidates.sort(reverse=True)
+
+    return dict(prefix_index)
+
+
+def segment_form(form, prefix_index, segment_map):
+    """
+    Segment a form by greedy longest matching of the graphemes in a profile.
+
+    Returns a list of tokens, which are either graphemes in `segment_map`
+    or single characters that could not be matched. Only the candidates
+    in `prefix_index` starting with the current character are tried,
+    skipping those which are no longer in `segment_map`.
+    """
+
+    # Candidates are compared in place with `str.startswith()`, so that no
+    # substring is allocated for each attempt
     i = 0
-    segments = []
-    while True:
-        match = False
-        for length in range(len(form[i:]), 0, -1):
-            needle = form[i : i + length]
-            if needle in segment_map:
-                if args.debug_wl:
-                    segments.append(
-                        "{%s}/{%s}" % (needle, segment_map[needle][args.ipa])
-                    )
-                else:
-                    segments.append(segment_map[needle][args.ipa])
-
-                # Update frequency and examples
-                segment_map[needle]["FREQUENCY"] += 1
-                segment_map[needle]["EXAMPLES"].append(form)
-                segment_map[needle]["LANGUAGES"].append(language)
-                i += length
-                match = True
+    tokens = []
+    while i < len(form):
+        # When nothing matches, take the single character
+        token = form[i]
+        for _, grapheme in prefix_index.get(token, ()):
+            if form.startswith(grapheme, i) and grapheme in segment_map:
+                token = grapheme
                 break
 
-        if not match:
-            if form[i] == " ":
-                if args.debug_wl:
-                    segments.append("{ }/{#}")
-                else:
-                    segments.append("#")
-            elif form[i] in ["^", "$"]:
-                if args.debug_wl:
-                    segments.append("{%s}/{}" % form[i])
-            else:
-                segments.append("<<%s>>" % form[i])
-            i += 1
+        tokens.append(token)
+        i += len(token)
+
+    return tokens
+
+
+def segment_with_ac(form, automaton, segment_map):
+    """
+    Segment a form with an Aho-Corasick automaton.
+
+    This is equivalent to `segment_form()`, matching leftmost-longest.
+    Hits for graphemes which are no longer in `segment_map` are ignored,
+    so that the same automaton can be used while rules are removed.
+    """
+
+    # Collect the length of the longest grapheme starting at each position;
+    # note that `automaton.iter_long()` is not used, as it can miss matches
+    # after a failed longer candidate (e.g., "ca" in "cccca" when "ccab" is
+    # in the profile), diverging from `segment_form()`
+    longest = [0] * len(form)
+    for end, (length, grapheme) in automaton.iter(form):
+        if grapheme in segment_map:
+            start = end - length + 1
+            longest[start] = max(longest[start], length)
+
+    # Walk the form, taking either the longest hit or a single character
+    i = 0
+    tokens = []
+    while i < len(form):
+        length = longest[i] or 1
+        tokens.append(form[i : i + length])
+        i += length
+
+    return tokens
+
+
+def build_segmenter(segment_map):
+    """
+    Return a function segmenting forms with the graphemes in a segment map.
+
+    The Aho-Corasick automaton is used if `pyahocorasick` is available,
+    falling back to the prefix index otherwise.
+    """
+
+    if ahocorasick:
+        automaton = build_automaton(segment_map)
+        return lambda form: segment_with_ac(form, automaton, segment_map)
+
+    prefix_index = build_prefix_index(segment_map)
+    return lambda form: segment_form(form, prefix_index, segment_map)
+
+
+def render_segments(tokens, segment_map, args, debug=False):
+    """
+    Return the segments for a list of tokens as given by `segment_form()`.
+
+    In debug mode, segments highlight which entry was matched for each
+    substring.
+    """
 
-        if i == len(form):
-            break
+    ipa_col = args.ipa
+    if debug:
+        unmatched = _UNMATCHED_DEBUG_SEGMENTS
+    else:
+        unmatched = _UNMATCHED_SEGMENTS
+
+    segments = []
+    for token in tokens:
+        if token in segment_map:
+            if debug:
+                segments.append(
+                    "{%s}/{%s}" % (token, segment_map[token][ipa_col])
+                )
+            else:
+                segments.append(segment_map[token][ipa_col])
+        elif token in unmatched:
+            segments.append(unmatched[token])
+        else:
+            segments.append("<<%s>>" % token)
 
     # remove nulls; note that this will keep NULLs in debug output,
     # showing what we are skipping over
@@ -335,6 +669,90 @@ def apply_profile_to_form(form, language, segment_map, args):
     return segments
 
 
+def sample_example(entry, form, size=3):
+    """
+    Update the sample of examples of an entry with a new matching form.
+
+    This uses reservoir sampling (Algorithm R) over all matches, so that
+    only `size` distinct forms are kept; the random generator stored in
+    the entry is seeded with its grapheme, so the sample is reproducible.
+    """
+
+    entry["_SEEN"] += 1
+    examples = entry["EXAMPLES"]
+    if form in examples:
+        return
+
+    if len(examples) < size:
+        examples.append(form)
+    else:
+        idx = entry["_RNG"].randrange(entry["_SEEN"])
+        if idx < size:
+            examples[idx] = form
+
+
+def segment_row(form, segment_map, segmenter, args):
+    """
+    Prepare and segment a wordlist form.
+
+    Returns the prepared form, its tokens, and its debug segments; the
+    segments are only rendered if a debug wordlist was requested, being
+    `None` otherwise.
+    """
+
+    # Read and prepare form (normalization is cached)
+    if not args.nonfc:
+        form = normalize(form)
+    if not args.nobound:
+        form = "^%s$" % form
+
+    # apply profile to the form
+    tokens = segmenter(form)
+
+    segments = None
+    if args.debug_wl:
+        segments = render_segments(tokens, segment_map, args, debug=True)
+
+    return form, tokens, segments
+
+
+# TODO: this is changing `segment_map` in place, improve
+def collect_matches(form, language, tokens, segment_map, frequencies):
+    """
+    Update frequency, examples, and languages of the entries matched in a form.
+
+    Frequencies are counted in the `frequencies` counter, by grapheme; the
+    language is not collected if it is `None`.
+    """
+
+    for token in tokens:
+        entry = segment_map.get(token)
+        if entry is not None:
+            frequencies[token] += 1
+            sample_example(entry, form)
+            if language is not None:
+                entry["LANGUAGES"].add(language)
+
+
+def _column_index(header, column, args):
+    """
+    Return the index of a column in the header of the wordlist.
+
+    Exits with an error message if the column is not found.
+    """
+
+    if column not in header:
+        logging.error(
+            "Column [%s] not found in wordlist %s (columns: %s).",
+            column,
+            args.wl,
+            ", ".join(header),
+        )
+        sys.exit(1)
+
+    return header.index(column)
+
+
 # TODO: use the segments library? we need to collect frequencies...
 # TODO: add debug mode
 def apply_profile(profile, args):
@@ -343,22 +761,15 @@ def apply_profile(profile, args):
 
     The segments can be returned in debug mode, to highlight which entry
     is being used.
-    """
 
-    # buffer for the debug wordlist
-    dwl_buffer = ""
+    The profile is updated in place, so its entries must have been cleared
+    by `clean_profile()` or `trim_profile()` with `prepare_for_apply=True`.
+    """
 
-    # Make a copy of the profile (so we don't change in place) and clear
-    # all frequencies
-    new_profile = []
+    # Set up the sampling of examples
     for entry in profile:
-        new_entry = entry.copy()
-        new_entry["FREQUENCY"] = 0
-        new_entry["EXAMPLES"] = []
-        new_entry["LANGUAGES"] = []
-        new_entry["TYPES"] = None
-        new_entry["SCA"] = None
-        new_profile.append(new_entry)
+        entry["_SEEN"] = 0
+        entry["_RNG"] = random.Random(entry[args.grapheme])
 
     # Use the specified delimiter
     if args.csv:
@@ -373,53 +784,96 @@ def apply_profile(profile, args):
         lang_id = pathlib.PurePosixPath(args.profile).name[:-4]
 
     # Build segment map, load the forms, and do the segmentation
-    segment_map = {entry[args.grapheme]: entry for entry in new_profile}
-    with open(args.wl) as wordlist:
-        reader = csv.DictReader(wordlist, delimiter=delimiter)
+    segment_map = {entry[args.grapheme]: entry for entry in profile}
+    segmenter = build_segmenter(segment_map)
+
+    with contextlib.ExitStack() as stack:
+        wordlist = stack.enter_context(
+            open(
+                args.wl,
+                encoding="utf-8",
+                newline="",
+                buffering=_WORDLIST_BUFFER,
+            )
+        )
 
-        # add header to buffer, if output was requested
+        # Open the debug wordlist, if output was requested, so that rows are
+        # written as soon as they are segmented
+        debug_file = None
         if args.debug_wl:
-            dwl_buffer = "%s\n" % delimiter.join(reader.fieldnames)
-
-        # iterate over rows
-        for row in reader:
-            # Skip if multiple language verification is requested and
-            # language id does not match
-            if args.multilang:
-                if row[args.lang_id] != lang_id:
-                    continue
-
-            # Run the segmentation, carrying information on language ID
-            # as well
-            segments = apply_profile_to_form(
-                row[args.form], row[args.lang_id], segment_map, args
+            debug_file = stack.enter_context(
+                open(args.debug_wl, "w", encoding="utf-8", newline="")
+            )
+            debug_writer = csv.writer(
+                debug_file, delimiter=delimiter, lineterminator="\n"
             )
 
-            # Collect output, if requested
-            if args.debug_wl:
-                row["Segments"] = " ".join(segments)
-                dwl_buffer += "%s\n" % delimiter.join(
-                    [row[field] for field in reader.fieldnames]
+        # Rows are read as lists, accessing the columns by their index; an
+        # empty wordlist has no rows, so there is nothing to look up; the
+        # language id column is only required for multilanguage checking,
+        # otherwise languages are collected only if it exists
+        reader = csv.reader(wordlist, delimiter=delimiter)
+        header = next(reader, [])
+        lang_col = None
+        if not header:
+            logging.warning("Wordlist %s is empty.", args.wl)
+        else:
+            form_col = _column_index(header, args.form, args)
+            if args.multilang or args.lang_id in header:
+                lang_col = _column_index(header, args.lang_id, args)
+            else:
+                logging.warning(
+                    "Column [%s] not found in wordlist %s, not collecting languages.",
+                    args.lang_id,
+                    args.wl,
                 )
 
-    # output debug wordlist if requested
-    if args.debug_wl:
-        with open(args.debug_wl, "w") as handler:
-            handler.write(dwl_buffer)
+        # Write header, if output was requested, adding a `Segments` column
+        # if the wordlist does not have one
+        if debug_file and header:
+            if "Segments" in header:
+                seg_col = header.index("Segments")
+            else:
+                seg_col = len(header)
+                header = header + ["Segments"]
+            debug_writer.writerow(header)
+
+        # Collect rows, skipping empty ones and, if multiple language
+        # verification is requested, those whose language id does not match
+        rows = (row for row in reader if row)
+        if args.multilang:
+            rows = (row for row in rows if row[lang_col] == lang_id)
+
+        # Run the segmentation, collecting the matches and carrying
+        # information on language ID as well
+        frequencies = Counter()
+        for row in rows:
+            form, tokens, segments = segment_row(
+                row[form_col], segment_map, segmenter, args
+            )
+            language = row[lang_col] if lang_col is not None else None
+            collect_matches(form, language, tokens, segment_map, frequencies)
+
+            # Write output, if requested, padding short rows so that the
+            # segments are written in their column
+            if debug_file:
+                row += [""] * (len(header) - len(row))
+                row[seg_col] = " ".join(segments)
+                debug_writer.writerow(row)
+
+    for grapheme, frequency in frequencies.items():
+        segment_map[grapheme]["FREQUENCY"] = frequency
 
     # Compile/fix remaining fields, such as frequency values (making sure
-    # they are all strings and getting some random but reproducible subset),
-    # building a list of languages, building sound class representations,
-    # etc.
-    for entry in new_profile:
+    # they are all strings), the sampled examples, building a list of
+    # languages, building sound class representations, etc.
+    for entry in profile:
         entry["FREQUENCY"] = str(entry["FREQUENCY"])
 
-        # Get a set of the examples, sample it, remove boundaries if
+        # Drop the sampling state, remove boundaries from the examples if
         # necessary, and join in a single sorted string
-        # Note that we seed with the Grapheme, so it is reproducible
-        examples = set(entry["EXAMPLES"])
-        random.seed(entry[args.grapheme])
-        example_sample = random.sample(examples, min(len(examples), 3))
+        del entry["_SEEN"], entry["_RNG"]
+        example_sample = entry["EXAMPLES"]
         if not args.nobound:
             example_sample = [form[1:-1] for form in example_sample]
 
@@ -430,24 +884,18 @@ def apply_profile(profile, args):
         entry["EXAMPLES"] = '"%s"' % example_sample
 
         # Get a sorted set of the languages
-        entry["LANGUAGES"] = ",".join(sorted(set(entry["LANGUAGES"])))
+        entry["LANGUAGES"] = ",".join(sorted(entry["LANGUAGES"]))
 
-    return new_profile
+    return profile
 
 
-def output_profile(profile, clts, args):
+def output_profile(profile, args):
     """
     Writes a profile to disk or to screen, using a default column order.
     """
 
     # Collect the fields used over the entire profile
-    prf_fields = set(
-        list(
-            itertools.chain.from_iterable(
-                [list(entry.keys()) for entry in profile]
-            )
-        )
-    )
+    prf_fields = set().union(*(entry.keys() for entry in profile))
 
     # From the list of default columns, build an output list (provided that the
     # field is found somewhere) and remove it from the `fields` we just collected
@@ -466,14 +914,41 @@ def output_profile(profile, clts, args):
     output_fields += sorted(
         [field for field in prf_fields if field not in output_fields]
     )
+    output_fields = tuple(output_fields)
+
+    # Output either to disk or to screen; on disk, the profile is written to
+    # a temporary file which only replaces the output once complete, so
+    # that an error never leaves a truncated profile (the output might be
+    # the very profile being formatted)
+    if args.output:
+        temp_path = pathlib.Path("%s.tmp" % args.output)
+        try:
+            with open(temp_path, "w", encoding="utf-8", newline="") as handler:
+                _write_profile_lines(handler, profile, output_fields, args)
+            os.replace(temp_path, args.output)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    else:
+        _write_profile_lines(sys.stdout, profile, output_fields, args)
+
+
+def _write_profile_lines(handler, profile, output_fields, args):
+    """
+    Writes the header and entries of a profile to an open file.
+
+    Lines are joined by hand, as the format is deliberately unquoted (the
+    EXAMPLES field carries its own quotes) and values must be written as
+    they are.
+    """
 
-    # Add headers to buffer
-    buffer = "%s\n" % "\t".join(output_fields)
+    # Write headers
+    handler.write("%s\n" % "\t".join(output_fields))
 
-    # Fill buffer with entries; as the `csv` library might have returned empty fields
+    # Write entries; as the `csv` library might have returned empty fields
     # as `None`, we need to check for those
     for entry in profile:
-        if entry["FREQUENCY"] == "0" and not args.keepzero:
+        if entry.get("FREQUENCY") == "0" and not args.keepzero:
             continue
 
         # For special symbols "^" and "$", the EXAMPLES column will be
@@ -484,20 +959,11 @@ def output_profile(profile, clts, args):
 
         # Map a grapheme column to a CLTS type column, overriding any
         # previous information
-        entry["TYPES"] = ipa2types(entry[args.ipa], clts)
-        entry["SCA"] = ipa2sca(entry[args.ipa], clts)
+        entry["TYPES"], entry["SCA"] = ipa2types_and_sca(entry[args.ipa])
 
-        # build line representation and extend buffer
-        tmp = [entry.get(field, "") for field in output_fields]
-        tmp = [value if value else "" for value in tmp]
-        buffer += "%s\n" % "\t".join(tmp)
-
-    # Output
-    if not args.output:
-        print(buffer)
-    else:
-        with open(args.output, "w") as handler:
-            handler.write(buffer)
+        # build line representation and write it
+        row = [entry.get(field) or "" for field in output_fields]
+        handler.write("%s\n" % "\t".join(row))
 
 
 def main(args):
@@ -505,16 +971,23 @@ def main(args):
     Entry point.
     """
 
-    # Load CLTS
+    # Intern the column names, as they are used as keys in all lookups
+    args.grapheme = sys.intern(args.grapheme)
+    args.ipa = sys.intern(args.ipa)
+    args.form = sys.intern(args.form)
+    args.lang_id = sys.intern(args.lang_id)
+
+    # Set the path to CLTS, which is only loaded if some segment is not
+    # found in the cache
     # TODO: use default repos path
-    clts = CLTS(pathlib.Path(args.clts).expanduser().as_posix())
+    set_clts_path(args.clts)
 
     # Load the profile
     profile = read_profile(args.profile, args)
 
     if args.command == "format":
         logging.info("Cleaning profile...")
-        profile = clean_profile(profile, clts, args)
+        profile = clean_profile(profile, args, prepare_for_apply=bool(args.wl))
 
         # Apply profile, collecting frequencies, if a wordlist was specified
         if args.wl:
@@ -525,25 +998,25 @@ def main(args):
     elif args.command == "trim":
         logging.info("Trimming profile...")
 
-        # Run the trimmer as many times as necessary until nothing more is left
-        # to remove
-        total_removed = 0
-        while True:
-            profile, removed = trim_profile(profile, clts, args)
-            total_removed += removed
-            if removed == 0:
-                break
-
-        logging.info("%i superfluous rules were removed.", total_removed)
+        # The trimmer checks again all rules affected by a removal, so a
+        # single run is enough
+        profile, removed = trim_profile(
+            profile, args, prepare_for_apply=bool(args.wl)
+        )
+        logging.info("%i superfluous rules were removed.", removed)
 
         # Apply profile, collecting frequencies, if a wordlist was specified
         if args.wl:
             profile = apply_profile(profile, args)
 
-    check_consistency(profile, clts, args)
+    check_consistency(profile, args)
 
     # Export
-    output_profile(profile, clts, args)
+    output_profile(profile, args)
+
+    # Update the cache on disk, if CLTS had to be loaded for new segments
+    if _BIPA is not None:
+        save_segment_cache()
 
 
 if __name__ == "__main__":